@@ -4,14 +4,17 @@ Tenwave Cortex Analyst App
 This app lets you chat with your Healthcare_Billing semantic model.
 """
 
-import json
-import time
+import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import _snowflake
+import orjson
 import pandas as pd
 import streamlit as st
+from snowflake.connector.errors import ProgrammingError
 from snowflake.snowpark.context import get_active_session
 from snowflake.snowpark.exceptions import SnowparkSQLException
 
@@ -23,17 +26,27 @@ AVAILABLE_SEMANTIC_MODELS_PATHS = [
 API_ENDPOINT = "/api/v2/cortex/analyst/message"
 FEEDBACK_API_ENDPOINT = "/api/v2/cortex/analyst/feedback"
 API_TIMEOUT = 50000  # ms
+RESULT_CHUNK_ROWS = 131072  # rows per chunk painted while a query result streams in
+QUERY_RESULT_CACHE_SIZE = 64  # query results kept in memory across sessions
+
+# Empty content item per type, filled in from streamed deltas
+EMPTY_CONTENT_ITEMS = {
+    "text": lambda: {"text": ""},
+    "sql": lambda: {"statement": "", "confidence": None},
+    "suggestions": lambda: {"suggestions": []},
+}
 
 session = get_active_session()
+logger = logging.getLogger(__name__)
 
 def main():
     if "messages" not in st.session_state:
         reset_session_state()
     show_header_and_sidebar()
+    new_turn = display_conversation()
     if len(st.session_state.messages) == 0:
-        process_user_input("What can I ask?")
-    display_conversation()
-    handle_user_inputs()
+        process_user_input("What can I ask?", new_turn)
+    handle_user_inputs(new_turn)
     handle_error_notifications()
     display_warnings()
 
@@ -62,21 +75,23 @@ def show_header_and_sidebar():
         if btn.button("Clear Chat History", use_container_width=True):
             reset_session_state()
 
-def handle_user_inputs():
+def handle_user_inputs(new_turn):
     user_input = st.chat_input("Ask a question...")
     if user_input:
-        process_user_input(user_input)
+        process_user_input(user_input, new_turn)
     elif st.session_state.active_suggestion:
         suggestion = st.session_state.active_suggestion
         st.session_state.active_suggestion = None
-        process_user_input(suggestion)
+        process_user_input(suggestion, new_turn)
 
 def handle_error_notifications():
     if st.session_state.get("fire_API_error_notify"):
         st.toast("⚠️ API error occurred!", icon="🚨")
         st.session_state["fire_API_error_notify"] = False
 
-def process_user_input(prompt: str):
+def process_user_input(prompt: str, new_turn):
+    """Answer prompt, drawing the turn into new_turn, the container owned by the
+    conversation fragment."""
     st.session_state.warnings = []
 
     new_user_message = {
@@ -84,64 +99,163 @@ def process_user_input(prompt: str):
         "content": [{"type": "text", "text": prompt}],
     }
     st.session_state.messages.append(new_user_message)
-    with st.chat_message("user"):
+    with new_turn, st.chat_message("user"):
         user_msg_index = len(st.session_state.messages) - 1
         display_message(new_user_message["content"], user_msg_index)
 
-    with st.chat_message("analyst"):
+    analyst_msg_index = len(st.session_state.messages)
+    with new_turn, st.chat_message("analyst"):
         with st.spinner("Waiting for Cortex Analyst..."):
-            time.sleep(1)
-            response, error_msg = get_analyst_response(st.session_state.messages)
-            if error_msg is None:
-                analyst_message = {
-                    "role": "analyst",
-                    "content": response["message"]["content"],
-                    "request_id": response["request_id"],
-                }
-            else:
-                analyst_message = {
-                    "role": "analyst",
-                    "content": [{"type": "text", "text": error_msg}],
-                    "request_id": response["request_id"],
-                }
-                st.session_state["fire_API_error_notify"] = True
-
-            if "warnings" in response:
-                st.session_state.warnings = response["warnings"]
+            events, request_id, error_msg = get_analyst_response(st.session_state.messages)
+        if error_msg is None:
+            analyst_message = {
+                "role": "analyst",
+                "content": [],
+                "request_id": request_id,
+            }
+            st.write_stream(stream_analyst(events, analyst_message))
+            display_message(
+                [item for item in analyst_message["content"] if item["type"] != "text"],
+                analyst_msg_index,
+                request_id,
+            )
+        else:
+            analyst_message = {
+                "role": "analyst",
+                "content": [{"type": "text", "text": error_msg}],
+                "request_id": request_id,
+            }
+            st.session_state["fire_API_error_notify"] = True
+            display_message(analyst_message["content"], analyst_msg_index, request_id)
 
-            st.session_state.messages.append(analyst_message)
-            st.rerun()
+    st.session_state.messages.append(analyst_message)
 
 def display_warnings():
     for warning in st.session_state.warnings:
         st.warning(warning["message"], icon="⚠️")
 
-def get_analyst_response(messages: List[Dict]) -> Tuple[Dict, Optional[str]]:
+class AnalystAPIError(Exception):
+    """Raised by the cached Analyst call so failed responses are not cached."""
+
+    def __init__(self, resp: Dict):
+        super().__init__(f"Analyst API request failed (status {resp['status']})")
+        self.resp = resp
+
+def _response_request_id(resp: Dict, events: List[Dict]) -> Optional[str]:
+    """Request id from the response header, else from the first streamed event carrying one."""
+    request_id = resp.get("headers", {}).get("X-Snowflake-Request-Id")
+    if request_id is None:
+        request_id = next(
+            (event["data"]["request_id"] for event in events
+             if isinstance(event.get("data"), dict) and event["data"].get("request_id")),
+            None,
+        )
+    if request_id is None:
+        logger.warning("Analyst response carried no request id; feedback is unavailable for it")
+    return request_id
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _analyst_call(model_path: str, messages_json: str, _fresh: Dict) -> List[Dict]:
+    """Return the Analyst event list, cached across sessions. Only a cache miss
+    writes the new request's id into _fresh, so a hit never hands one session
+    another session's request id for feedback."""
     request_body = {
-        "messages": messages,
-        "semantic_model_file": f"@{st.session_state.selected_semantic_model_path}",
+        "messages": orjson.loads(messages_json),
+        "semantic_model_file": f"@{model_path}",
+        "stream": True,
     }
 
     resp = _snowflake.send_snow_api_request(
         "POST", API_ENDPOINT, {}, {}, request_body, None, API_TIMEOUT
     )
-    parsed_content = json.loads(resp["content"])
+    if resp["status"] >= 400:
+        raise AnalystAPIError(resp)
+    events = orjson.loads(resp["content"])
+    # Errors can also arrive as streamed events inside a 200 response
+    if any(event.get("event") == "error" for event in events):
+        raise AnalystAPIError(resp)
+    _fresh["request_id"] = _response_request_id(resp, events)
+    return events
+
+def get_analyst_response(messages: List[Dict]) -> Tuple[List[Dict], Optional[str], Optional[str]]:
+    fresh: Dict = {}
+    try:
+        events = _analyst_call(
+            st.session_state.selected_semantic_model_path,
+            orjson.dumps(messages, option=orjson.OPT_SORT_KEYS).decode(),
+            fresh,
+        )
+        # Cache hits leave the request id unset, so no feedback is offered for them
+        return events, fresh.get("request_id"), None
+    except AnalystAPIError as e:
+        resp = e.resp
+    parsed_content = orjson.loads(resp["content"])
 
     if resp["status"] < 400:
-        return parsed_content, None
+        # Streamed error events; stream_analyst renders them
+        return parsed_content, _response_request_id(resp, parsed_content), None
     else:
+        request_id = parsed_content.get("request_id") or resp.get("headers", {}).get("X-Snowflake-Request-Id")
         err_msg = f"""
 🚨 Analyst API error 🚨
 
 * Status: `{resp['status']}`
-* Request ID: `{parsed_content['request_id']}`
+* Request ID: `{request_id}`
 * Code: `{parsed_content['error_code']}`
 
 Message:
         """
-        return parsed_content, err_msg
+        return [], request_id, err_msg
+
+def stream_analyst(events: List[Dict], analyst_message: Dict) -> Iterator[str]:
+    """Yield text deltas from the Analyst event stream, building the full
+    message content (text, sql, suggestions) on analyst_message as it goes."""
+    items: Dict[int, Dict] = {}
+    for event in events:
+        data = event.get("data", {})
+        if event.get("event") == "message.content.delta":
+            empty_item = EMPTY_CONTENT_ITEMS.get(data.get("type"))
+            if empty_item is None:
+                # Content types this app does not render are skipped
+                continue
+            item = items.get(data["index"])
+            if item is None:
+                item = {"type": data["type"], **empty_item()}
+                items[data["index"]] = item
+                analyst_message["content"].append(item)
+            if data["type"] == "text":
+                item["text"] += data["text_delta"]
+                yield data["text_delta"]
+            elif data["type"] == "sql":
+                item["statement"] += data["statement_delta"]
+                if data.get("confidence"):
+                    item["confidence"] = data["confidence"]
+            elif data["type"] == "suggestions":
+                delta = data["suggestions_delta"]
+                suggestions = item["suggestions"]
+                while len(suggestions) <= delta["index"]:
+                    suggestions.append("")
+                suggestions[delta["index"]] += delta["suggestion_delta"]
+        elif event.get("event") == "warnings":
+            st.session_state.warnings = data["warnings"]
+        elif event.get("event") == "error":
+            st.session_state["fire_API_error_notify"] = True
+            err_msg = f"""
+🚨 Analyst API error 🚨
 
+* Request ID: `{data.get('request_id')}`
+* Code: `{data.get('code')}`
+
+Message: {data.get('message')}
+            """
+            analyst_message["content"].append({"type": "text", "text": err_msg})
+            yield err_msg
+
+@st.fragment
 def display_conversation():
+    """Draw the history and return an empty container for this run's new turn.
+    The container belongs to the fragment, so a later fragment rerun replaces
+    the new turn with its copy from the history instead of duplicating it."""
     for idx, message in enumerate(st.session_state.messages):
         role = message["role"]
         content = message["content"]
@@ -150,6 +264,7 @@ def display_conversation():
                 display_message(content, idx, message["request_id"])
             else:
                 display_message(content, idx)
+    return st.container()
 
 def display_message(content: List[Dict], idx: int, request_id: Optional[str] = None):
     for item in content:
@@ -161,16 +276,70 @@ def display_message(content: List[Dict], idx: int, request_id: Optional[str] = N
                     suggestion, key=f"suggestion_{idx}_{s_idx}"
                 ):
                     st.session_state.active_suggestion = suggestion
+                    # The conversation is a fragment; the question is handled by the full app run
+                    st.rerun()
         elif item["type"] == "sql":
             display_sql_query(item["statement"], idx, item["confidence"], request_id)
 
-@st.cache_data(show_spinner=False)
-def get_query_exec_result(query: str) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+def iter_result_chunks(query: str, chunk_rows: int = RESULT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    with session.connection.cursor() as cursor:
+        cursor.execute(query)
+        for arrow_tbl in cursor.fetch_arrow_batches():
+            # Columnar Arrow -> pandas conversion without per-row object boxing
+            for batch in arrow_tbl.to_batches(max_chunksize=chunk_rows):
+                yield batch.to_pandas(types_mapper=pd.ArrowDtype)
+
+class QueryResultCache:
+    """Bounded LRU of query results shared across sessions. Results are handed
+    out without copying, so callers must not mutate the returned DataFrames."""
+
+    def __init__(self, max_entries: int):
+        self._results: OrderedDict = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[Tuple[Optional[pd.DataFrame], Optional[str]]]:
+        with self._lock:
+            result = self._results.get(query)
+            if result is not None:
+                self._results.move_to_end(query)
+            return result
+
+    def put(self, query: str, result: Tuple[Optional[pd.DataFrame], Optional[str]]):
+        with self._lock:
+            self._results[query] = result
+            self._results.move_to_end(query)
+            while len(self._results) > self._max_entries:
+                self._results.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_query_result_cache() -> QueryResultCache:
+    return QueryResultCache(QUERY_RESULT_CACHE_SIZE)
+
+def get_query_exec_result(query: str, placeholder) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    result_cache = get_query_result_cache()
+    cached = result_cache.get(query)
+    if cached is not None:
+        return cached
+
+    chunks = []
+    rows = 0
     try:
-        df = session.sql(query).to_pandas()
-        return df, None
-    except SnowparkSQLException as e:
-        return None, str(e)
+        for chunk in iter_result_chunks(query):
+            chunks.append(chunk)
+            rows += len(chunk)
+            # Show only the latest batch while fetching; the full frame is built once at the end
+            with placeholder.container():
+                st.caption(f"Fetched {rows:,} rows...")
+                st.dataframe(chunk, use_container_width=True)
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        result = (df, None)
+    except (SnowparkSQLException, ProgrammingError) as e:
+        result = (None, str(e))
+    placeholder.empty()
+
+    result_cache.put(query, result)
+    return result
 
 def display_sql_query(sql: str, idx: int, confidence: dict, request_id: Optional[str]):
     with st.expander("SQL Query"):
@@ -179,7 +348,7 @@ def display_sql_query(sql: str, idx: int, confidence: dict, request_id: Optional
 
     with st.expander("Results"):
         with st.spinner("Running SQL..."):
-            df, err = get_query_exec_result(sql)
+            df, err = get_query_exec_result(sql, st.empty())
             if df is None:
                 st.error(f"Error: {err}")
             elif df.empty:
@@ -216,10 +385,11 @@ def display_charts_tab(df: pd.DataFrame, idx: int):
         chart = st.selectbox(
             "Chart type", ["Line Chart", "Bar Chart"], key=f"chart_{idx}"
         )
+        # Pass the columns by name; set_index(x)[y] copied the frame on every selectbox change
         if chart == "Line Chart":
-            st.line_chart(df.set_index(x)[y])
+            st.line_chart(df, x=x, y=y)
         else:
-            st.bar_chart(df.set_index(x)[y])
+            st.bar_chart(df, x=x, y=y)
     else:
         st.write("At least 2 columns needed for chart.")
 
@@ -250,7 +420,7 @@ def submit_feedback(request_id: str, positive: bool, message: str) -> Optional[s
     )
     if resp["status"] == 200:
         return None
-    parsed = json.loads(resp["content"])
+    parsed = orjson.loads(resp["content"])
     return f"""
 🚨 Feedback API error 🚨
 * Status: `{resp['status']}`
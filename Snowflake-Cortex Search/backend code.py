@@ -46,7 +46,11 @@ CREATE OR REPLACE STAGE STAGE_AWS
   URL = 's3://mykritikbucket/patient_reports/'
   STORAGE_INTEGRATION = dr_aws_int
   ENCRYPTION=( TYPE = 'AWS_SSE_S3' )
-  DIRECTORY = (ENABLE = TRUE);
+  DIRECTORY = (ENABLE = TRUE AUTO_REFRESH = TRUE);
+
+-- Directory auto-refresh is event driven: point the bucket's S3 event notifications
+-- (object created/removed under patient_reports/) at the SQS ARN in directory_notification_channel
+DESC STAGE STAGE_AWS;
 
 ls @STAGE_AWS;
 
@@ -57,6 +61,7 @@ SELECT
     RELATIVE_PATH,
     SIZE,
     FILE_URL,
+    REPLACE(COALESCE(MD5, ETAG), '"', '') AS MD5,
     BUILD_SCOPED_FILE_URL(@STAGE_AWS, RELATIVE_PATH) AS SCOPED_FILE_URL,
     (SNOWFLAKE.CORTEX.PARSE_DOCUMENT(
         '@STAGE_AWS',
@@ -67,8 +72,22 @@ FROM
     DIRECTORY(@STAGE_AWS);
 SELECT * FROM RAW_TEXT;
 
+-- Parsed layout per file content, so identical bytes are never sent to PARSE_DOCUMENT twice
+CREATE OR REPLACE TABLE DOC_PARSE_CACHE (
+    MD5 VARCHAR(128) PRIMARY KEY, -- Content hash from the stage directory (unquoted ETag, possibly "<hash>-<parts>", when MD5 is missing)
+    RELATIVE_PATH VARCHAR(16777216), -- Path the content was first parsed from
+    EXTRACTED_LAYOUT VARCHAR(16777216) -- PARSE_DOCUMENT layout output
+);
+
+-- Seed the cache from the initial parse
+INSERT INTO DOC_PARSE_CACHE (MD5, RELATIVE_PATH, EXTRACTED_LAYOUT)
+    SELECT MD5, RELATIVE_PATH, EXTRACTED_LAYOUT
+    FROM RAW_TEXT
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY MD5 ORDER BY RELATIVE_PATH) = 1;
+
 
 -- Step 2: Create table to store document chunks
+-- Clustered on RELATIVE_PATH so the per-document DELETE in INSERT_DELETE_DOCS_SP prunes micro-partitions
 CREATE OR REPLACE TABLE DOCS_CHUNKS_TABLE ( 
     RELATIVE_PATH VARCHAR(16777216), -- Relative path to the PDF file
     SIZE NUMBER(38,0), -- Size of the PDF
@@ -77,7 +96,10 @@ CREATE OR REPLACE TABLE DOCS_CHUNKS_TABLE (
     CHUNK VARCHAR(16777216), -- Piece of text
     CHUNK_INDEX INTEGER, -- Index for the text
     CATEGORY VARCHAR(16777216) -- Document category for filtering
-);
+)
+CLUSTER BY (RELATIVE_PATH);
+-- For a table created before clustering was added:
+-- ALTER TABLE DOCS_CHUNKS_TABLE CLUSTER BY (RELATIVE_PATH);
 select * from DOCS_CHUNKS_TABLE;
 
 -- Step 3: Split text into chunks using SNOWFLAKE.CORTEX.SPLIT_TEXT_RECURSIVE_CHARACTER
@@ -146,13 +168,23 @@ BEGIN
     WHERE DOCS_CHUNKS_TABLE.RELATIVE_PATH = DELETE_DOCS_STREAM.RELATIVE_PATH
       AND DELETE_DOCS_STREAM.METADATA$ACTION = 'DELETE';
 
-  -- Step 2: Parse newly inserted documents
-  CREATE OR REPLACE TEMPORARY TABLE RAW_TEXT AS
+  -- Step 2: Read newly inserted documents from the stream once
+  CREATE OR REPLACE TEMPORARY TABLE NEW_DOCS AS
     SELECT 
         RELATIVE_PATH,
         SIZE,
         FILE_URL,
-        BUILD_SCOPED_FILE_URL(@STAGE_AWS, RELATIVE_PATH) AS SCOPED_FILE_URL,
+        REPLACE(COALESCE(MD5, ETAG), '"', '') AS MD5
+    FROM 
+        INSERT_DOCS_STREAM
+    WHERE 
+        METADATA$ACTION = 'INSERT';
+
+  -- Step 3: Parse only content not seen before and add it to the parse cache
+  INSERT INTO DOC_PARSE_CACHE (MD5, RELATIVE_PATH, EXTRACTED_LAYOUT)
+    SELECT 
+        MD5,
+        RELATIVE_PATH,
         TO_VARCHAR(
             SNOWFLAKE.CORTEX.PARSE_DOCUMENT(
                 '@STAGE_AWS',
@@ -160,12 +192,26 @@ BEGIN
                 OBJECT_CONSTRUCT('mode', 'LAYOUT')
             ):content
         ) AS EXTRACTED_LAYOUT
+    FROM (
+        SELECT MD5, RELATIVE_PATH
+        FROM NEW_DOCS n
+        WHERE NOT EXISTS (SELECT 1 FROM DOC_PARSE_CACHE c WHERE c.MD5 = n.MD5)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY MD5 ORDER BY RELATIVE_PATH) = 1
+    );
+
+  -- Step 4: Take every new document's layout from the cache
+  CREATE OR REPLACE TEMPORARY TABLE RAW_TEXT AS
+    SELECT 
+        n.RELATIVE_PATH,
+        n.SIZE,
+        n.FILE_URL,
+        BUILD_SCOPED_FILE_URL(@STAGE_AWS, n.RELATIVE_PATH) AS SCOPED_FILE_URL,
+        c.EXTRACTED_LAYOUT
     FROM 
-        INSERT_DOCS_STREAM
-    WHERE 
-        METADATA$ACTION = 'INSERT';
+        NEW_DOCS n
+        JOIN DOC_PARSE_CACHE c ON c.MD5 = n.MD5;
 
-    -- Step 3: Insert new document chunks
+    -- Step 5: Insert new document chunks
   INSERT INTO DOCS_CHUNKS_TABLE (
     RELATIVE_PATH, SIZE, FILE_URL, SCOPED_FILE_URL, CHUNK, CHUNK_INDEX
   )
@@ -186,6 +232,14 @@ BEGIN
         ['\n\n', '\n', ' ', '']
     )) c;
 
+  -- Step 6: Evict parses whose content is no longer anywhere on the stage
+  DELETE FROM DOC_PARSE_CACHE c
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM DIRECTORY(@STAGE_AWS) d
+        WHERE REPLACE(COALESCE(d.MD5, d.ETAG), '"', '') = c.MD5
+    );
+
   RETURN 'Insert/Delete Document Sync Complete';
 END;
 $$;
@@ -197,7 +251,7 @@ $$;
 -- Create task for automatic processing
 CREATE OR REPLACE TASK INSERT_DELETE_DOCS_TASK
   WAREHOUSE = kritik_warehouse
-  SCHEDULE = '2 minute'
+  SCHEDULE = '1 minute'
   WHEN SYSTEM$STREAM_HAS_DATA('DELETE_DOCS_STREAM') OR SYSTEM$STREAM_HAS_DATA('INSERT_DOCS_STREAM')
   AS
     CALL INSERT_DELETE_DOCS_SP();
@@ -206,16 +260,6 @@ ALTER TASK INSERT_DELETE_DOCS_TASK RESUME;
 
 
 
---TO REFRESH THE STAGE
-CREATE OR REPLACE TASK REFRESH_STAGE_TASK
-  WAREHOUSE = kritik_warehouse
-  SCHEDULE = '1 MINUTE'
-  AS
-    ALTER STAGE STAGE_AWS REFRESH;
-ALTER TASK REFRESH_STAGE_TASK RESUME;
-
-
-
 
 -- Verify streams
 SELECT * FROM DELETE_DOCS_STREAM;
@@ -294,35 +338,6 @@ GRANT ROLE ACCOUNTADMIN TO USER Analytx4tlab;
 
 
 
--- Create function text_chunker
-create or replace function text_chunker(pdf_text string)
-returns table (chunk varchar)
-language python
-runtime_version = '3.9'
-handler = 'text_chunker'
-packages = ('snowflake-snowpark-python', 'langchain')
-as
-$$
-from snowflake.snowpark.types import StringType, StructField, StructType
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import pandas as pd
-
-class text_chunker:
-
-    def process(self, pdf_text: str):
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size = 1512, #Adjust this as you see fit
-            chunk_overlap  = 256, #This let's text have some form of overlap. Useful for keeping chunks contextual
-            length_function = len
-        )
-    
-        chunks = text_splitter.split_text(pdf_text)
-        df = pd.DataFrame(chunks, columns=['chunks'])
-        
-        yield from df.itertuples(index=False, name=None)
-$$;
-
 
 -- create internal stage
 create or replace stage docs ENCRYPTION = (TYPE = 'SNOWFLAKE_SSE') DIRECTORY = ( ENABLE = true );
@@ -342,57 +357,16 @@ create or replace TABLE DOCS_CHUNKS_TABLE (
     SCOPED_FILE_URL VARCHAR(16777216), -- Scoped url (you can choose which one to keep depending on your use case)
     CHUNK VARCHAR(16777216), -- Piece of text
     CATEGORY VARCHAR(16777216) -- Will hold the document category to enable filtering
-);
+)
+CLUSTER BY (RELATIVE_PATH);
 
 
 
--- insert into docs_chunks_table
---insert into docs_chunks_table (relative_path, size, file_url,
---                            scoped_file_url, chunk)
---
---    select relative_path, 
---            size,
---            file_url, 
---            build_scoped_file_url(@STAGE_AWS, relative_path) as scoped_file_url,
---            func.chunk as chunk
---    from 
---        directory(@STAGE_AWS),
---        TABLE(text_chunker (TO_VARCHAR(SNOWFLAKE.CORTEX.PARSE_DOCUMENT(@STAGE_AWS, 
---                              relative_path, {'mode': 'LAYOUT'})))) as func;
 
 SELECT * FROM DOCS_CHUNKS_TABLE;
 select * from docs_chunks_table limit 5;
 
 
--- -- create stream docs_stream on stage docs
--- create or replace stream docs_stream on stage docs;
-
--- create or replace task parse_and_insert_pdf_task 
---     warehouse = COMPUTE_WH
---     schedule = '1 minute'
---     when system$stream_has_data('docs_stream')
---     as
-  
---     insert into docs_chunks_table (relative_path, size, file_url,
---                             scoped_file_url, chunk)
---     select relative_path, 
---             size,
---             file_url, 
---             build_scoped_file_url(@docs, relative_path) as scoped_file_url,
---             func.chunk as chunk
---     from 
---         docs_stream,
---         TABLE(text_chunker (TO_VARCHAR(SNOWFLAKE.CORTEX.PARSE_DOCUMENT(@docs, relative_path, {'mode': 'LAYOUT'})))) as func;
-
--- alter task parse_and_insert_pdf_task resume;
-
--- select * from docs_stream;
-
--- --
--- ALTER TASK parse_and_insert_pdf_task SUSPEND;
-
--- --
--- ALTER TASK parse_and_insert_pdf_task RESUME;
 
 
 
@@ -1,9 +1,16 @@
 import streamlit as st
 import pandas as pd
-import json
+import orjson
 import re
-from typing import List, Dict, Any, Tuple, Set, Optional
+import hashlib
+import time
+import threading
+import numpy as np
+from typing import List, Dict, Any, Tuple, Set, Optional, Callable, Iterator
 from functools import lru_cache
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
 from snowflake.snowpark.context import get_active_session
 from snowflake.cortex import Complete
 from snowflake.core import Root
@@ -15,6 +22,12 @@ pd.set_option("max_colwidth", None)
 APP_CONFIG = {
     "NUM_CHUNKS": 10,
     "SLIDING_WINDOW": 7,
+    "MAX_MESSAGES_IN_UI": 200,
+    # Per-turn character caps for history sent to the LLM
+    "HISTORY_CHARS": {
+        "assistant": 400,
+        "User": 200
+    },
     "MODEL": "llama3.3-70b",
     "DEFAULT_CATEGORY": "ALL",
     "INITIAL_QUESTIONS": [
@@ -27,11 +40,71 @@ APP_CONFIG = {
         "DATABASE": "kritik_db",
         "SCHEMA": "DATA",
         "SERVICE": "KK_SEARCH_SERVICE_CS",
-        "TABLE": "docs_chunks_table"
+        "TABLE": "docs_chunks_table",
+        "DOCS_STAGE": "docs"
+    },
+    "SEARCH_COLUMNS": ["chunk", "relative_path"],
+    # Retrieved chunk text beyond this many characters is cut before building the prompt
+    "CONTEXT_CHAR_BUDGET": 16000,
+    # Presigned document links; reuse stops well before the links expire
+    "PRESIGNED_URL": {
+        "EXPIRY_SECONDS": 360,
+        "REUSE_SECONDS": 300,
+        "MAX_ENTRIES": 1024
+    },
+    # Worker threads for overlapped Snowflake calls, shared by all sessions; each in-flight
+    # question uses at most two, so this serves ~16 concurrent questions without queueing
+    "IO_POOL_WORKERS": 32,
+    # Reuse the raw-question search when the history-extended query overlaps it at least this much
+    "QUERY_REUSE_JACCARD": 0.6,
+    # Finished completions (blocking and streamed), shared across sessions
+    "COMPLETION_CACHE": {
+        "TTL_SECONDS": 1800,
+        "MAX_ENTRIES": 256
     },
-    "SEARCH_COLUMNS": ["chunk", "relative_path", "category"]
+    "SEMANTIC_CACHE": {
+        "EMBED_MODEL": "e5-base-v2",
+        "SIMILARITY_THRESHOLD": 0.92,
+        "MAX_ENTRIES": 256
+    }
 }
 
+# Precompiled patterns used by ResponseProcessor
+_HIDDEN_SECTION_HEADERS = (
+    "Related Questions",
+    "You might also want to know",
+    "Suggested Questions",
+    "Common Questions",
+    "Follow-up Questions"
+)
+# All hidden sections in one alternation so the response is scanned once
+_HIDDEN_SECTIONS_RE = re.compile(
+    r'(?:\n|\r\n)?(?:' + '|'.join(map(re.escape, _HIDDEN_SECTION_HEADERS)) + r'):.*?(?=\n\n|\Z)',
+    re.DOTALL
+)
+_SECTION_PATTERNS = [re.compile(pattern, re.DOTALL) for pattern in (
+    r'Related Questions:(.*?)(?:\n\n|\Z)',
+    r'Common Issues:(.*?)(?:\n\n|\Z)',
+    r'Common Issues and Solutions:(.*?)(?:\n\n|\Z)',
+    r'Scenario-Based Questions:(.*?)(?:\n\n|\Z)',
+    r'Follow-up Questions:(.*?)(?:\n\n|\Z)',
+    r'You might also want to know:(.*?)(?:\n\n|\Z)'
+)]
+_CONTEXT_SECTION_PATTERNS = [re.compile(pattern, re.DOTALL) for pattern in (
+    r'Common Issues?:(.*?)(?=\n\n|\Z)',
+    r'Scenarios?:(.*?)(?=\n\n|\Z)',
+    r'Use Cases?:(.*?)(?=\n\n|\Z)',
+    r'Common Queries:(.*?)(?=\n\n|\Z)'
+)]
+_BULLET_Q = re.compile(r'[-•*]\s*(.*?\?)')
+_NUMBERED_Q = re.compile(r'\d+\.\s*(.*?\?)')
+_SENTENCE_Q = re.compile(r'([A-Z][^.!?]*\?)')
+_GENERAL_Q = re.compile(r'([A-Z][^.!?]{10,}?\?)')
+_VIDEO_RE = re.compile(r'Video Guide:\s*\[(.*?)\]\((.*?)\)')
+_EXTRA_NL = re.compile(r'\n{3,}')
+# Code fences and quoted lines in earlier answers add prompt length without helping retrieval
+_HISTORY_NOISE_RE = re.compile(r'```.*?```|^>[^\n]*\n?', re.DOTALL | re.MULTILINE)
+
 
 class SnowflakeService:
     """Handles all Snowflake-related operations with caching for performance"""
@@ -40,35 +113,68 @@ class SnowflakeService:
         self.session = get_active_session()
         self.root = Root(self.session)
         self.search_service = self._initialize_search_service()
+        # The service is shared by every session, so the URL memo is guarded by a lock
+        self._url_cache: Dict[str, Tuple[str, float]] = {}
+        self._url_lock = threading.Lock()
     
     def _initialize_search_service(self):
         """Initialize the Cortex search service"""
         return self.root.databases[APP_CONFIG["SNOWFLAKE"]["DATABASE"]].schemas[
             APP_CONFIG["SNOWFLAKE"]["SCHEMA"]].cortex_search_services[APP_CONFIG["SNOWFLAKE"]["SERVICE"]]
     
-    @lru_cache(maxsize=32)
     def get_available_categories(self) -> List[str]:
-        """Fetch all distinct categories from the documents table (cached)"""
-        categories = self.session.table(APP_CONFIG["SNOWFLAKE"]["TABLE"]).select('category').distinct().collect()
-        return ['ALL'] + [cat.CATEGORY for cat in categories]
+        """Fetch all distinct categories from the documents table (cached across sessions)"""
+        config = APP_CONFIG["SNOWFLAKE"]
+        return _fetch_categories(self.session, config["DATABASE"], config["SCHEMA"], config["TABLE"])
     
-    @lru_cache(maxsize=1)
     def get_available_documents(self) -> pd.DataFrame:
-        """List all available documents in the storage location (cached)"""
-        return self.session.sql("ls @docs").collect()
+        """List all available documents in the storage location (cached across sessions)"""
+        config = APP_CONFIG["SNOWFLAKE"]
+        return _fetch_documents(self.session, config["DATABASE"], config["SCHEMA"], config["DOCS_STAGE"])
     
     def get_document_url(self, path: str) -> str:
         """Generate a presigned URL for a document path"""
+        return self.get_document_urls([path]).get(path, "#")
+    
+    def get_document_urls(self, paths: List[str]) -> Dict[str, str]:
+        """Generate presigned URLs for several document paths, querying only those not memoized"""
+        if not paths:
+            return {}
+        config = APP_CONFIG["PRESIGNED_URL"]
+        now = time.monotonic()
+        
+        urls = {}
+        missing = []
+        with self._url_lock:
+            for path in paths:
+                cached = self._url_cache.get(path)
+                if cached is not None and cached[1] > now:
+                    urls[path] = cached[0]
+                else:
+                    missing.append(path)
+        if not missing:
+            return urls
+        
         try:
-            # Ensure correct database and schema context
-            self.session.sql("USE DATABASE kritik_db").collect()
-            self.session.sql("USE SCHEMA data").collect()
-            cmd = f"SELECT GET_PRESIGNED_URL(@kritik_db.data.STAGE_AWS, '{path}', 360) AS URL_LINK FROM DIRECTORY(@kritik_db.data.STAGE_AWS)"
-            df_url_link = self.session.sql(cmd).to_pandas()
-            return df_url_link._get_value(0, 'URL_LINK')
+            # The stage is fully qualified, so no USE DATABASE/SCHEMA round-trips are needed
+            values = ", ".join(["(?)"] * len(missing))
+            cmd = f"""SELECT column1 AS RELATIVE_PATH,
+                      GET_PRESIGNED_URL(@kritik_db.data.STAGE_AWS, column1, {config["EXPIRY_SECONDS"]}) AS URL_LINK
+                      FROM VALUES {values}"""
+            rows = self.session.sql(cmd, params=missing).collect()
         except Exception as e:
-            st.error(f"Error generating URL for {path}: {str(e)}")
-            return "#"
+            st.error(f"Error generating URLs for {', '.join(missing)}: {str(e)}")
+            urls.update((path, "#") for path in missing)
+            return urls
+        
+        expires = now + config["REUSE_SECONDS"]
+        with self._url_lock:
+            if len(self._url_cache) >= config["MAX_ENTRIES"]:
+                self._url_cache = {path: entry for path, entry in self._url_cache.items() if entry[1] > now}
+            for row in rows:
+                urls[row.RELATIVE_PATH] = row.URL_LINK
+                self._url_cache[row.RELATIVE_PATH] = (row.URL_LINK, expires)
+        return urls
     
     def search_similar_chunks(self, query: str, category: str, num_chunks: int) -> Dict[str, Any]:
         """Search for semantically similar chunks in the document collection"""
@@ -83,222 +189,369 @@ class SnowflakeService:
                 limit=num_chunks
             )
         
-        return response.json()
+        # Parse once here so callers always get a dict
+        return orjson.loads(response.json())
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Embed text with Cortex EMBED_TEXT_768 for semantic cache lookups"""
+        model = APP_CONFIG["SEMANTIC_CACHE"]["EMBED_MODEL"]
+        row = self.session.sql(
+            f"SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768('{model}', ?) AS EMBEDDING",
+            params=[text]
+        ).collect()[0]
+        return np.asarray(row.EMBEDDING, dtype=np.float32)
     
     def complete_with_llm(self, model_name: str, prompt: str) -> str:
-        """Generate a completion using the specified model"""
-        return Complete(model_name, prompt)
+        """Generate a completion using the specified model (cached by prompt digest)"""
+        cache_key = (model_name, _prompt_digest(prompt))
+        completion_cache = get_completion_cache()
+        response = completion_cache.get(cache_key)
+        if response is None:
+            response = Complete(model_name, prompt)
+            completion_cache.put(cache_key, response)
+        return response
+    
+    def complete_with_llm_stream(self, model_name: str, prompt: str) -> Iterator[str]:
+        """Generate a completion using the specified model, yielding text chunks as they arrive"""
+        return Complete(model_name, prompt, stream=True)
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _fetch_categories(_session, database: str, schema: str, table: str) -> List[str]:
+    """Distinct document categories, keyed on the table's qualified name rather than a service instance"""
+    categories = _session.table(f"{database}.{schema}.{table}").select('category').distinct().collect()
+    return ['ALL'] + [cat.CATEGORY for cat in categories]
+
+
+@st.cache_data(show_spinner=False, ttl=600)
+def _fetch_documents(_session, database: str, schema: str, stage: str) -> pd.DataFrame:
+    """Stage file listing, keyed on the stage's qualified name rather than a service instance"""
+    return _session.sql(f"ls @{database}.{schema}.{stage}").to_pandas()
+
+
+def _prompt_digest(prompt: str) -> str:
+    """Short stable digest used to key the completion cache on the full prompt text"""
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+
+class CompletionCache:
+    """Bounded LRU of finished completion text by (model, prompt digest), with a TTL.
+    Used for both blocking and streamed completions; st.cache_data can only memoize
+    a whole call, so it cannot hold text assembled from a stream."""
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._entries: OrderedDict = OrderedDict()  # key -> (text, expiry)
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+    
+    def get(self, key: Tuple[str, str]) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+    
+    def put(self, key: Tuple[str, str], text: str):
+        with self._lock:
+            self._entries[key] = (text, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+@st.cache_resource
+def get_completion_cache() -> CompletionCache:
+    """Completion cache shared by every session"""
+    config = APP_CONFIG["COMPLETION_CACHE"]
+    return CompletionCache(config["MAX_ENTRIES"], config["TTL_SECONDS"])
+
+
+@st.cache_resource
+def get_io_pool() -> ThreadPoolExecutor:
+    """Shared pool for overlapping network-bound Snowflake calls within a turn.
+    Workers issue queries on the shared Snowpark session alongside the script thread;
+    Snowpark sessions are thread-safe for concurrent queries (snowflake-snowpark-python 1.24+)"""
+    return ThreadPoolExecutor(max_workers=APP_CONFIG["IO_POOL_WORKERS"])
+
+
+def _query_jaccard(a: str, b: str) -> float:
+    """Word-set Jaccard similarity, a cheap check of whether two search queries differ"""
+    words_a, words_b = set(a.lower().split()), set(b.lower().split())
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+def _replace_video_link(match: "re.Match[str]") -> str:
+    """Rewrite one Video Guide link, pointing internal video paths at a YouTube search"""
+    video_title, video_url = match.group(1), match.group(2)
+    
+    # Replace internal path with YouTube link format; YouTube and other links pass through
+    if "internal_video_path" in video_url and "youtube.com" not in video_url and "youtu.be" not in video_url:
+        search_query = video_title.replace(" ", "+")
+        video_url = f"https://www.youtube.com/results?search_query={search_query}+hospital+information+system"
+    return f"Video Guide: [📹 {video_title}]({video_url})"
+
 
 class ResponseProcessor:
     """Processes and manipulates responses for improved display"""
     
     @staticmethod
+    @lru_cache(maxsize=256)
     def clean_assistant_response(content: str) -> str:
-        """Remove hidden sections from displayed response"""
-        patterns_to_remove = [
-            r'(?:\n|\r\n)?Related Questions:.*?(?=\n\n|\Z)',
-            r'(?:\n|\r\n)?You might also want to know:.*?(?=\n\n|\Z)',
-            r'(?:\n|\r\n)?Suggested Questions:.*?(?=\n\n|\Z)',
-            r'(?:\n|\r\n)?Common Questions:.*?(?=\n\n|\Z)',
-            r'(?:\n|\r\n)?Follow-up Questions:.*?(?=\n\n|\Z)'
-        ]
-        
-        cleaned_content = content
-        for pattern in patterns_to_remove:
-            cleaned_content = re.sub(pattern, '', cleaned_content, flags=re.DOTALL)
-        
-        # Clean up any extra newlines that might be left
-        cleaned_content = re.sub(r'\n{3,}', '\n\n', cleaned_content)
+        """Remove hidden sections from displayed response (memoized per response text)"""
+        return ResponseProcessor.strip_hidden_sections(content)
+    
+    @staticmethod
+    def strip_hidden_sections(content: str) -> str:
+        """Remove hidden sections without memoizing, for partial text while a response streams"""
+        cleaned_content = _HIDDEN_SECTIONS_RE.sub('', content)
+        
+        # Clean up any extra newlines that might be left (skip the rebuild when there are none)
+        if '\n\n\n' in cleaned_content:
+            cleaned_content = _EXTRA_NL.sub('\n\n', cleaned_content)
         
         return cleaned_content.strip()
     
     @staticmethod
     def extract_related_questions(response: str, context_data: dict) -> List[str]:
         """Extract questions from the response to make them clickable"""
-        questions = []
-        
-        # Extract sections containing questions
-        section_patterns = [
-            r'Related Questions:(.*?)(?:\n\n|\Z)',
-            r'Common Issues:(.*?)(?:\n\n|\Z)',
-            r'Common Issues and Solutions:(.*?)(?:\n\n|\Z)', 
-            r'Scenario-Based Questions:(.*?)(?:\n\n|\Z)',
-            r'Follow-up Questions:(.*?)(?:\n\n|\Z)',
-            r'You might also want to know:(.*?)(?:\n\n|\Z)'
-        ]
+        questions: List[str] = []
+        seen: Set[str] = set()
+        
+        def add_question(question: str):
+            clean_question = question.strip()
+            if (clean_question and clean_question not in seen and 
+                    "video" not in clean_question.lower() and len(clean_question) < 100):
+                seen.add(clean_question)
+                questions.append(clean_question)
         
         # First try to get questions from explicit sections
         found_questions = False
-        for pattern in section_patterns:
-            section_match = re.search(pattern, response, re.DOTALL)
+        for pattern in _SECTION_PATTERNS:
+            section_match = pattern.search(response)
             if section_match:
                 found_questions = True
                 section_text = section_match.group(1)
                 
                 # Extract questions from the section
-                bullet_questions = re.findall(r'[-•*]\s*(.*?\?)', section_text)
-                numbered_questions = re.findall(r'\d+\.\s*(.*?\?)', section_text)
+                bullet_questions = _BULLET_Q.findall(section_text)
+                numbered_questions = _NUMBERED_Q.findall(section_text)
                 
                 for question in bullet_questions + numbered_questions:
-                    clean_question = question.strip()
-                    if (clean_question and clean_question not in questions and 
-                            "video" not in clean_question.lower() and len(clean_question) < 100):
-                        questions.append(clean_question)
+                    add_question(question)
         
         # If not enough questions found, extract from context
         if not found_questions or len(questions) < 3:
-            ResponseProcessor._extract_questions_from_context(questions, context_data)
+            ResponseProcessor._extract_questions_from_context(add_question, context_data)
         
         # If still not enough questions, look for general questions in the response
         if len(questions) < 3:
-            ResponseProcessor._extract_general_questions(questions, response)
+            ResponseProcessor._extract_general_questions(add_question, response)
         
         # Limit to 4 questions max
         return questions[:4]
     
     @staticmethod
-    def _extract_questions_from_context(questions: List[str], context_data: dict):
+    def _extract_questions_from_context(add_question: Callable[[str], None], context_data: dict):
         """Extract questions from the context data"""
         if isinstance(context_data, dict) and 'results' in context_data:
             chunks = [item.get('chunk', '') for item in context_data.get('results', [])]
             combined_chunks = ' '.join(chunks)
             
             # Look for sections containing questions
-            context_patterns = [
-                r'Common Issues?:(.*?)(?=\n\n|\Z)',
-                r'Scenarios?:(.*?)(?=\n\n|\Z)',
-                r'Use Cases?:(.*?)(?=\n\n|\Z)',
-                r'Common Queries:(.*?)(?=\n\n|\Z)'
-            ]
-            
-            for pattern in context_patterns:
-                section_match = re.search(pattern, combined_chunks, re.DOTALL)
+            for pattern in _CONTEXT_SECTION_PATTERNS:
+                section_match = pattern.search(combined_chunks)
                 if section_match:
                     section_text = section_match.group(1)
                     
                     # Extract questions from the section
-                    context_questions = re.findall(r'[-•*]\s*(.*?\?)', section_text)
+                    context_questions = _BULLET_Q.findall(section_text)
                     if not context_questions:
                         # Try to find sentences ending with question marks
-                        context_questions = re.findall(r'([A-Z][^.!?]*\?)', section_text)
+                        context_questions = _SENTENCE_Q.findall(section_text)
                     
                     for question in context_questions:
-                        clean_question = question.strip()
-                        if (clean_question and clean_question not in questions and 
-                                "video" not in clean_question.lower() and len(clean_question) < 100):
-                            questions.append(clean_question)
+                        add_question(question)
     
     @staticmethod
-    def _extract_general_questions(questions: List[str], response: str):
+    def _extract_general_questions(add_question: Callable[[str], None], response: str):
         """Extract general questions from the response"""
-        general_questions = re.findall(r'([A-Z][^.!?]{10,}?\?)', response)
+        general_questions = _GENERAL_Q.findall(response)
         for question in general_questions:
-            clean_question = question.strip()
-            if (clean_question and clean_question not in questions and 
-                    "video" not in clean_question.lower() and len(clean_question) < 100):
-                questions.append(clean_question)
+            add_question(question)
     
     @staticmethod
+    @lru_cache(maxsize=256)
     def process_video_links(response: str) -> str:
-        """Process video links to make them work with YouTube"""
-        video_pattern = r'Video Guide:\s*\[(.*?)\]\((.*?)\)'
-        
-        def replace_video_link(match):
-            video_title = match.group(1)
-            video_url = match.group(2)
-            
-            # Replace internal path with YouTube link format
-            if "youtube.com" in video_url or "youtu.be" in video_url:
-                return f"Video Guide: [📹 {video_title}]({video_url})"
-            elif "internal_video_path" in video_url:
-                search_query = video_title.replace(" ", "+")
-                youtube_search_url = f"https://www.youtube.com/results?search_query={search_query}+hospital+information+system"
-                return f"Video Guide: [📹 {video_title}]({youtube_search_url})"
-            else:
-                return f"Video Guide: [📹 {video_title}]({video_url})"
-        
-        # Replace video links with proper YouTube search links
-        return re.sub(video_pattern, replace_video_link, response)
+        """Process video links to make them work with YouTube (memoized per response text)"""
+        # Quick reject: most responses carry no video guide, so skip the regex scan entirely
+        if "Video Guide:" not in response:
+            return response
+        return _VIDEO_RE.sub(_replace_video_link, response)
+
+
+# Static instructions that open the main prompt, ahead of every per-turn field
+_MAIN_PROMPT_PREFIX = """
+You are a specialized medical assistant designed to assist healthcare providers in extracting and analyzing patient information from medical records, discharge summaries, clinical notes, and external lab reports. Your goal is to provide accurate, concise medical information based solely on the data within the <context> and </context> tags, while considering prior interactions in the <chat_history> and </chat_history> tags.
+
+### Guidelines for Answering
+- Respond directly to the query using precise medical terminology where appropriate.
+- Extract and organize patient information from the provided context efficiently.
+- For queries with multiple clinical questions, address each part separately in clear, labeled sections.
+- If the query asks for a complete summary (e.g., "everything in that report"), provide all available details from the context, organized by categories such as patient demographics, medical history, diagnoses, treatments, procedures, lab results, and clinical notes.
+- Use bullet points, short paragraphs, or tables for readability, emphasizing key findings, diagnoses, treatments, and recommendations.
+- If information is missing, state: "The patient record does not contain information about that specific question."
+- Avoid speculation, external knowledge, or excessive elaboration unless a full summary is requested.
+
+### Patient Context Awareness
+- Identify the patient in the query and confirm if it matches the context or differs from chat history.
+- If the query references a new patient (by name, ID, or case), use only the current context for that patient.
+- If no matching information is found for a queried patient, respond: "I don’t have information about that patient in the current records. The information I have is for [current patient name/ID]."
+- If patient identity is unclear, note: "Patient identity is unclear in the context; using available data for [current patient name/ID if determinable]."
+- Never mix data from different patients.
+
+### External Lab Reports Integration
+- Match lab reports to the patient using:
+  * Unique Health ID (UHID) as the primary identifier
+  * Patient name (allow for minor spelling variations)
+  * Age, gender, referring doctor, and test date (if aligned with treatment timeline)
+- Correlate lab findings with clinical history and current presentation, noting the source (e.g., "Per external lab report").
+- If internal and external lab results conflict, present both clearly, attributing each source.
+- If lab data is incomplete or unmatchable, state: "External lab report data is incomplete or does not match the patient reliably."
+
+### Response Structure
+- Confirm the patient identity (name/ID) if available in the context.
+- Break down complex queries into components and address each in a logical, clinical order.
+- For comprehensive summary requests (e.g., "everything in that report"), structure the response with clear sections:
+  * Patient Demographics: Name, ID, age, gender, etc.
+  * Medical History: Past conditions, surgeries, allergies, etc.
+  * Diagnoses: Current and past diagnoses from the context.
+  * Treatments: Medications, therapies, interventions, etc.
+  * Procedures: Surgeries, interventions, or other procedures.
+  * Lab Results: Internal and external lab findings, with sources.
+  * Clinical Notes: Key observations, progress notes, etc.
+- Prioritize recent data from the context over older chat history if discrepancies arise.
+"""
+# Tags of the main prompt after the prefix, split around its three insertion points
+_MAIN_PROMPT_PARTS = (
+"""
+<context>
+""",
+"""
+</context>
+
+<chat_history>
+""",
+"""
+</chat_history>
+
+<question>
+""",
+"""
+</question>
+"""
+)
 
 
 class PromptBuilder:
     """Builds prompts for LLM interaction"""
     
     @staticmethod
-    def create_chat_summary_prompt(chat_history: List[Dict[str, str]], question: str) -> str:
-        """Create a prompt to summarize the conversation context"""
+    def _format_history(chat_history: List[Dict[str, str]]) -> str:
+        """Serialize the last SLIDING_WINDOW turns as compact JSON, keeping only role and content"""
+        recent = chat_history[-APP_CONFIG["SLIDING_WINDOW"]:]
+        return orjson.dumps([{"role": m["role"], "content": m["content"]} for m in recent]).decode()
+    
+    @staticmethod
+    def create_chat_summary_prompt(prev_summary: str, new_messages: List[Dict[str, str]], question: str) -> str:
+        """Create a prompt that folds the messages since the last summary into it"""
         return f"""
-        Based on the chat history below and the question, generate a query that extend the question
-        with the chat history provided. The query should be in natual language. 
+        Based on the prior summary of the conversation, the new chat messages below and the question,
+        generate a query that extend the question with the conversation so far. The query should be in natual language. 
         Answer with only the query. Do not add any explanation.
         
-        <chat_history>
-        {chat_history}
-        </chat_history>
+        <prior_summary>
+        {prev_summary}
+        </prior_summary>
+        <new>
+        {PromptBuilder._format_history(new_messages)}
+        </new>
         <question>
         {question}
         </question>"""
     
+    @staticmethod
     def create_main_prompt(question: str, chat_history: List, prompt_context: Dict) -> str:
         """Create a streamlined main prompt for the LLM with retrieved context for medical assistance."""
-        return f"""
-        You are a specialized medical assistant designed to assist healthcare providers in extracting and analyzing patient information from medical records, discharge summaries, clinical notes, and external lab reports. Your goal is to provide accurate, concise medical information based solely on the data within the <context> and </context> tags, while considering prior interactions in the <chat_history> and </chat_history> tags.
-        
-        ### Guidelines for Answering
-        - Respond directly to the query using precise medical terminology where appropriate.
-        - Extract and organize patient information from the provided context efficiently.
-        - For queries with multiple clinical questions, address each part separately in clear, labeled sections.
-        - If the query asks for a complete summary (e.g., "everything in that report"), provide all available details from the context, organized by categories such as patient demographics, medical history, diagnoses, treatments, procedures, lab results, and clinical notes.
-        - Use bullet points, short paragraphs, or tables for readability, emphasizing key findings, diagnoses, treatments, and recommendations.
-        - If information is missing, state: "The patient record does not contain information about that specific question."
-        - Avoid speculation, external knowledge, or excessive elaboration unless a full summary is requested.
-        
-        ### Patient Context Awareness
-        - Identify the patient in the query and confirm if it matches the context or differs from chat history.
-        - If the query references a new patient (by name, ID, or case), use only the current context for that patient.
-        - If no matching information is found for a queried patient, respond: "I don’t have information about that patient in the current records. The information I have is for [current patient name/ID]."
-        - If patient identity is unclear, note: "Patient identity is unclear in the context; using available data for [current patient name/ID if determinable]."
-        - Never mix data from different patients.
-        
-        ### External Lab Reports Integration
-        - Match lab reports to the patient using:
-          * Unique Health ID (UHID) as the primary identifier
-          * Patient name (allow for minor spelling variations)
-          * Age, gender, referring doctor, and test date (if aligned with treatment timeline)
-        - Correlate lab findings with clinical history and current presentation, noting the source (e.g., "Per external lab report").
-        - If internal and external lab results conflict, present both clearly, attributing each source.
-        - If lab data is incomplete or unmatchable, state: "External lab report data is incomplete or does not match the patient reliably."
-        
-        ### Response Structure
-        - Confirm the patient identity (name/ID) if available in the context.
-        - Break down complex queries into components and address each in a logical, clinical order.
-        - For comprehensive summary requests (e.g., "everything in that report"), structure the response with clear sections:
-          * Patient Demographics: Name, ID, age, gender, etc.
-          * Medical History: Past conditions, surgeries, allergies, etc.
-          * Diagnoses: Current and past diagnoses from the context.
-          * Treatments: Medications, therapies, interventions, etc.
-          * Procedures: Surgeries, interventions, or other procedures.
-          * Lab Results: Internal and external lab findings, with sources.
-          * Clinical Notes: Key observations, progress notes, etc.
-        - Prioritize recent data from the context over older chat history if discrepancies arise.
-        
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        
-        <context>
-        {prompt_context}
-        </context>
-        
-        <question>
-        {question}
-        </question>
-        """
+        return "".join((
+            _MAIN_PROMPT_PREFIX,
+            _MAIN_PROMPT_PARTS[0], orjson.dumps(prompt_context).decode(),
+            _MAIN_PROMPT_PARTS[1], PromptBuilder._format_history(chat_history),
+            _MAIN_PROMPT_PARTS[2], question,
+            _MAIN_PROMPT_PARTS[3]
+        ))
         
     
 
 
 
+class SemanticCache:
+    """Bounded LRU of answers keyed by question embedding, matched on cosine similarity
+    within a scope (model, category and conversation state) so answers never leak across contexts"""
+    
+    def __init__(self):
+        self.threshold = APP_CONFIG["SEMANTIC_CACHE"]["SIMILARITY_THRESHOLD"]
+        self.max_entries = APP_CONFIG["SEMANTIC_CACHE"]["MAX_ENTRIES"]
+        self._entries: OrderedDict = OrderedDict()  # key -> (scope, unit embedding, answer)
+        self._next_key = 0
+        # Stacked (N, 768) embedding matrix and row scopes, rebuilt lazily after inserts
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[int] = []
+        self._matrix_scopes: List[str] = []
+    
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+    
+    def lookup(self, embedding: np.ndarray, scope: str) -> Optional[Tuple]:
+        """Return the answer cached for the most similar question in the same scope, if similar enough"""
+        if not self._entries:
+            return None
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix_scopes = [self._entries[key][0] for key in self._matrix_keys]
+            self._matrix = np.stack([self._entries[key][1] for key in self._matrix_keys])
+        
+        # Rows are unit vectors, so one matrix-vector product gives every cosine similarity
+        similarities = self._matrix @ self._normalize(embedding)
+        in_scope = np.fromiter((s == scope for s in self._matrix_scopes), dtype=bool, count=len(self._matrix_scopes))
+        if not in_scope.any():
+            return None
+        similarities[~in_scope] = -np.inf
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        
+        key = self._matrix_keys[best]
+        self._entries.move_to_end(key)
+        return self._entries[key][2]
+    
+    def insert(self, embedding: np.ndarray, scope: str, answer: Tuple):
+        """Cache an answer under its scope, evicting the least recently used entry when full"""
+        self._entries[self._next_key] = (scope, self._normalize(embedding), answer)
+        self._next_key += 1
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._matrix = None
+
+
 class ChatState:
     """Manages the application state"""
     
@@ -306,7 +559,10 @@ class ChatState:
     def initialize():
         """Initialize session state variables with defaults"""
         if "messages" not in st.session_state:
-            st.session_state.messages = []
+            st.session_state.messages = deque(maxlen=APP_CONFIG["MAX_MESSAGES_IN_UI"])
+        
+        if "sem_cache" not in st.session_state:
+            st.session_state.sem_cache = SemanticCache()
             
         # Initialize configurable parameters
         defaults = {
@@ -319,7 +575,11 @@ class ChatState:
             "suggested_questions": APP_CONFIG["INITIAL_QUESTIONS"],
             "question_asked": False,
             "current_question": "",
-            "related_documents": []
+            "related_documents": [],
+            "last_summary": "",
+            "last_summary_upto": 0,
+            "message_count": 0,
+            "last_response_hash": None
         }
         
         for key, value in defaults.items():
@@ -329,17 +589,92 @@ class ChatState:
     @staticmethod
     def clear_conversation():
         """Reset the conversation history"""
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=APP_CONFIG["MAX_MESSAGES_IN_UI"])
+        st.session_state.message_count = 0
         st.session_state.suggested_questions = APP_CONFIG["INITIAL_QUESTIONS"]
         st.session_state.question_asked = False
         st.session_state.related_documents = []
+        st.session_state.last_summary = ""
+        st.session_state.last_summary_upto = 0
+        st.session_state.sem_cache = SemanticCache()
+    
+    @staticmethod
+    def append_message(message: Dict[str, str]):
+        """Append to the bounded message store, counting every message ever added"""
+        st.session_state.messages.append(message)
+        st.session_state.message_count += 1
+
+
+# Custom CSS injected on every run (Streamlit drops elements a rerun does not emit)
+_CUSTOM_CSS = """
+<style>
+.stButton > button, .stFormSubmitButton > button {
+    background-color: #f0f2f6;
+    border: 1px solid #e0e0e0;
+    border-radius: 8px;
+    padding: 10px;
+    font-size: 14px;
+    transition: all 0.3s;
+    text-align: left;
+}
+.stButton > button:hover, .stFormSubmitButton > button:hover {
+    background-color: #e6f0ff;
+    border-color: #4da6ff;
+}
+.chat-message {
+    padding: 15px;
+    border-radius: 10px;
+    margin-bottom: 10px;
+}
+/* Add custom header styling */
+.app-header {
+    text-align: center;
+    margin-bottom: 20px;
+}
+.app-header h1 {
+    color: #1E88E5;
+}
+/* Improved question button styling */
+.question-button {
+    background-color: #f8f9fa;
+    border-radius: 12px;
+    box-shadow: 0 2px 5px rgba(0,0,0,0.1);
+    transition: all 0.2s ease;
+}
+.question-button:hover {
+    transform: translateY(-2px);
+    box-shadow: 0 4px 8px rgba(0,0,0,0.15);
+}
+/* Style for document links */
+.document-link {
+    padding: 8px;
+    border-radius: 8px;
+    background-color: #f8f9fa;
+    margin-bottom: 5px;
+    display: block;
+}
+/* Containers for layout */
+.chat-container {
+    padding: 10px;
+}
+.image-container {
+    padding: 10px;
+    text-align: center;
+}
+/* Clear button styling */
+.clear-button {
+    margin-top: 10px;
+    width: 100%;
+}
+</style>
+"""
 
 
 class ChatApp:
     """Main chat application class"""
     
     def __init__(self):
-        self.snowflake_service = SnowflakeService()
+        self.snowflake_service = get_snowflake_service()
         self.response_processor = ResponseProcessor()
     
     def run(self):
@@ -358,78 +693,17 @@ class ChatApp:
         # Initialize state
         ChatState.initialize()
         
-        # Render UI
-        self._render_main_interface()
+        # Read this run's question up front so it can be answered inline below the history
+        question = self._get_pending_question()
         
-        # Handle user input
-        self._handle_user_input()
+        # Render UI
+        self._render_main_interface(question)
     
     def _apply_custom_css(self):
         """Apply custom CSS for improved UI"""
-        st.markdown("""
-        <style>
-        .stButton > button {
-            background-color: #f0f2f6;
-            border: 1px solid #e0e0e0;
-            border-radius: 8px;
-            padding: 10px;
-            font-size: 14px;
-            transition: all 0.3s;
-            text-align: left;
-        }
-        .stButton > button:hover {
-            background-color: #e6f0ff;
-            border-color: #4da6ff;
-        }
-        .chat-message {
-            padding: 15px;
-            border-radius: 10px;
-            margin-bottom: 10px;
-        }
-        /* Add custom header styling */
-        .app-header {
-            text-align: center;
-            margin-bottom: 20px;
-        }
-        .app-header h1 {
-            color: #1E88E5;
-        }
-        /* Improved question button styling */
-        .question-button {
-            background-color: #f8f9fa;
-            border-radius: 12px;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-            transition: all 0.2s ease;
-        }
-        .question-button:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 4px 8px rgba(0,0,0,0.15);
-        }
-        /* Style for document links */
-        .document-link {
-            padding: 8px;
-            border-radius: 8px;
-            background-color: #f8f9fa;
-            margin-bottom: 5px;
-            display: block;
-        }
-        /* Containers for layout */
-        .chat-container {
-            padding: 10px;
-        }
-        .image-container {
-            padding: 10px;
-            text-align: center;
-        }
-        /* Clear button styling */
-        .clear-button {
-            margin-top: 10px;
-            width: 100%;
-        }
-        </style>
-        """, unsafe_allow_html=True)
+        st.markdown(_CUSTOM_CSS, unsafe_allow_html=True)
     
-    def _render_main_interface(self):
+    def _render_main_interface(self, question: Optional[str]):
         """Render the main interface with a two-column layout"""
         st.markdown("<div class='app-header'>", unsafe_allow_html=True)
         st.title("Doctor Summary")
@@ -440,7 +714,7 @@ class ChatApp:
         
         with col1:
             # Chat interface in left column
-            self._render_chat_interface()
+            self._render_chat_interface(question)
         
         with col2:
             # Image and related documents in right column
@@ -453,12 +727,15 @@ class ChatApp:
             st.markdown("</div>", unsafe_allow_html=True)
             
             # Add clear button below the logo
-            if st.button("Clear Conversation", key="clear_button", use_container_width=True):
-                ChatState.clear_conversation()
-                st.experimental_rerun()
+            st.button(
+                "Clear Conversation",
+                key="clear_button",
+                use_container_width=True,
+                on_click=ChatState.clear_conversation
+            )
             
     
-    def _render_chat_interface(self):
+    def _render_chat_interface(self, question: Optional[str]):
         """Render the chat messages and input area"""
         st.markdown("<div class='chat-container'>", unsafe_allow_html=True)
         
@@ -466,159 +743,238 @@ class ChatApp:
         for message in st.session_state.messages:
             with st.chat_message(message["role"]):
                 if message["role"] == "assistant":
-                    cleaned_content = ResponseProcessor.clean_assistant_response(message["content"])
+                    cleaned_content = message.get("_cleaned")
+                    if cleaned_content is None:
+                        cleaned_content = ResponseProcessor.clean_assistant_response(message["content"])
+                        message["_cleaned"] = cleaned_content
                     st.markdown(cleaned_content)
                 else:
                     st.markdown(message["content"])
         
-        # Display suggested questions if no conversation has started
-        if not st.session_state.messages:
+        # Answer this run's question in place, or offer suggestions if no conversation has started
+        if question:
+            self._handle_user_input(question)
+        elif not st.session_state.messages:
             st.write("👋 Welcome! You can ask me questions about the Patient Information or choose from these common questions:")
             self._display_suggested_questions()
             
         st.markdown("</div>", unsafe_allow_html=True)
     
     def _display_suggested_questions(self):
-        """Display clickable suggested questions buttons"""
-        cols = st.columns(2)
-        for i, question in enumerate(st.session_state.suggested_questions):
-            col_idx = i % 2
-            with cols[col_idx]:
-                if st.button(f"🔍 {question}", key=f"suggested_q_{i}", use_container_width=True):
-                    st.session_state.current_question = question
-                    st.session_state.question_asked = True
-    
-    def _handle_user_input(self):
-        """Process user input from chat interface"""
-        # Process flagged questions from button clicks
-        if st.session_state.question_asked and st.session_state.current_question:
-            self._process_question(st.session_state.current_question)
-            st.session_state.question_asked = False
-            st.session_state.current_question = ""
-            st.experimental_rerun()
-        
-        # Get user input from chat interface
+        """Display clickable suggested questions as submit buttons of a single form"""
+        with st.form("suggested_q_form", clear_on_submit=False, border=False):
+            cols = st.columns(2)
+            for i, question in enumerate(st.session_state.suggested_questions):
+                col_idx = i % 2
+                with cols[col_idx]:
+                    st.form_submit_button(
+                        f"🔍 {question}",
+                        use_container_width=True,
+                        on_click=self._ask_suggested_question,
+                        args=(question,)
+                    )
+    
+    @staticmethod
+    def _ask_suggested_question(question: str):
+        """Queue a suggested question; runs as a button callback before the rerun starts"""
+        st.session_state.current_question = question
+        st.session_state.question_asked = True
+    
+    def _get_pending_question(self) -> Optional[str]:
+        """Return the question to answer this run, from the chat box or a queued suggestion"""
         question = st.chat_input("Type your question here...")
         
-        if question:
-            # Add user message to chat history
-            st.session_state.messages.append({"role": "User", "content": question})
-            
-            # Display user message
-            with st.chat_message("User"):
-                st.markdown(question)
-                
-            # Process and display assistant response
-            with st.chat_message("assistant"):
-                message_placeholder = st.empty()
-                response, relative_paths = self._process_user_input(question)
-                
-                cleaned_response = ResponseProcessor.clean_assistant_response(response)
-                message_placeholder.markdown(cleaned_response)
-                
-                # Update related documents
-                self._update_related_documents(relative_paths)
-                
-            # Add assistant message to chat history
-            st.session_state.messages.append({"role": "assistant", "content": response})
-            
-            st.experimental_rerun()
+        # Consume questions flagged by suggestion button clicks
+        if st.session_state.question_asked and st.session_state.current_question:
+            question = st.session_state.current_question
+        st.session_state.question_asked = False
+        st.session_state.current_question = ""
+        
+        return question
     
-    def _process_question(self, question: str):
-        """Process a question from button click"""
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "User", "content": question})
+    def _handle_user_input(self, question: str):
+        """Render the question and stream the assistant response, without rerunning the script"""
+        # Start the embedding and raw-question search before drawing anything, so their
+        # round-trips overlap rendering; worker threads get plain values, never session state
+        pool = get_io_pool()
+        # With history on, every turn has a different scope, so a cache lookup could never hit
+        embedding = None
+        if not st.session_state.use_chat_history:
+            embedding = pool.submit(self.snowflake_service.embed, question)
+        raw_search = pool.submit(
+            self.snowflake_service.search_similar_chunks,
+            question,
+            st.session_state.category_value,
+            st.session_state.num_chunks
+        )
         
-        # Process and get assistant response
-        response, relative_paths = self._process_user_input(question)
+        # Add user message to chat history
+        ChatState.append_message({"role": "User", "content": question})
         
-        # Add assistant message to chat history
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        # Display user message
+        with st.chat_message("User"):
+            st.markdown(question)
+            
+        # Process and display assistant response
+        with st.chat_message("assistant"):
+            message_placeholder = st.empty()
+            response, relative_paths = self._process_user_input(question, message_placeholder, embedding, raw_search)
+            
+            cleaned_response = ResponseProcessor.clean_assistant_response(response)
+            message_placeholder.markdown(cleaned_response)
+            
+        # Add assistant message to chat history, keeping the cleaned markdown for later reruns
+        ChatState.append_message({"role": "assistant", "content": response, "_cleaned": cleaned_response})
         
-        # Update related documents
+        # Resolve document links only once the answer is on screen and stored
         self._update_related_documents(relative_paths)
     
-    def _process_user_input(self, question: str) -> Tuple[str, Set[str]]:
-        """Process user question and generate response"""
-        # Sanitize question
-        question = question.replace("'", "")
+    def _process_user_input(self, question: str, message_placeholder, embedding: Optional[Future],
+                            raw_search: Future) -> Tuple[str, Set[str]]:
+        """Process user question and generate response, streaming it into message_placeholder"""
+        # Answer near-duplicates of earlier questions without retrieval or LLM calls
+        cache_scope = self._semantic_cache_scope()
+        if embedding is not None:
+            try:
+                embedding = embedding.result()
+            except Exception:
+                # The semantic cache is only a shortcut; answer normally if embedding fails
+                embedding = None
+        cached = st.session_state.sem_cache.lookup(embedding, cache_scope) if embedding is not None else None
+        if cached is not None:
+            raw_search.cancel()
+            response, relative_paths, cached_questions = cached
+            if cached_questions and cached_questions != st.session_state.suggested_questions:
+                st.session_state.suggested_questions = cached_questions
+            return response, relative_paths
         
         # Create prompt and get response
-        prompt, relative_paths, context_data = self._create_prompt(question)
+        prompt, relative_paths, context_data = self._create_prompt(question, raw_search)
         
-        with st.spinner(f"Thinking..."):
-            response = self.snowflake_service.complete_with_llm(st.session_state.model_name, prompt)
+        response = self._stream_response(prompt, message_placeholder)
             
-        # Process video links and sanitize response
+        # Process video links
         response = ResponseProcessor.process_video_links(response)
-        response = response.replace("'", "")
         
-        # Extract questions from response to update suggested questions
-        new_questions = ResponseProcessor.extract_related_questions(response, context_data)
-        if new_questions:
-            st.session_state.suggested_questions = new_questions
+        # Extract questions from response to update suggested questions, unless the response is unchanged
+        new_questions = []
+        response_hash = hash(response)
+        if response_hash != st.session_state.last_response_hash:
+            st.session_state.last_response_hash = response_hash
+            new_questions = ResponseProcessor.extract_related_questions(response, context_data)
+            if new_questions and new_questions != st.session_state.suggested_questions:
+                st.session_state.suggested_questions = new_questions
+        
+        if embedding is not None:
+            st.session_state.sem_cache.insert(embedding, cache_scope, (response, relative_paths, new_questions))
         
         return response, relative_paths
     
-    def _create_prompt(self, question: str) -> Tuple[str, Set[str], Dict]:
-        """Create the prompt for the LLM with retrieved context"""
+    def _semantic_cache_scope(self) -> str:
+        """Fingerprint everything besides the question that shapes a history-free answer: model and category"""
+        parts = [st.session_state.model_name, st.session_state.category_value]
+        return hashlib.blake2b(orjson.dumps(parts), digest_size=16).hexdigest()
+    
+    def _stream_response(self, prompt: str, message_placeholder) -> str:
+        """Render the completion into the placeholder as tokens arrive and return the full text;
+        a prompt answered before is returned from the completion cache without calling the LLM"""
+        model_name = st.session_state.model_name
+        cache_key = (model_name, _prompt_digest(prompt))
+        completion_cache = get_completion_cache()
+        response = completion_cache.get(cache_key)
+        if response is not None:
+            return response
+        
+        response = ""
+        for chunk in self.snowflake_service.complete_with_llm_stream(model_name, prompt):
+            response += chunk
+            message_placeholder.markdown(ResponseProcessor.strip_hidden_sections(response) + "▌")
+        completion_cache.put(cache_key, response)
+        return response
+    
+    def _create_prompt(self, question: str, raw_search: Future) -> Tuple[str, Set[str], Dict]:
+        """Create the prompt for the LLM with retrieved context, given the in-flight raw-question search"""
         chat_history = []
-        prompt_context = {}
+        search = self.snowflake_service.search_similar_chunks
+        category = st.session_state.category_value
+        num_chunks = st.session_state.num_chunks
         
-        # Decide whether to use history and how to retrieve similar chunks
+        # Decide whether to use history to extend the retrieval query
         if st.session_state.use_chat_history and len(st.session_state.messages) > 0:
             chat_history = self._get_chat_history()
-            if chat_history:
-                summary = self._summarize_conversation(chat_history, question)
-                prompt_context = self.snowflake_service.search_similar_chunks(
-                    summary, 
-                    st.session_state.category_value, 
-                    st.session_state.num_chunks
-                )
+            
+            # The raw-question search keeps running while the summary is produced
+            search_query = self._summarize_conversation(question)
+            
+            if _query_jaccard(search_query, question) >= APP_CONFIG["QUERY_REUSE_JACCARD"]:
+                prompt_context = raw_search.result()
             else:
-                prompt_context = self.snowflake_service.search_similar_chunks(
-                    question, 
-                    st.session_state.category_value, 
-                    st.session_state.num_chunks
-                )
+                raw_search.cancel()
+                prompt_context = search(search_query, category, num_chunks)
         else:
-            prompt_context = self.snowflake_service.search_similar_chunks(
-                question, 
-                st.session_state.category_value, 
-                st.session_state.num_chunks
-            )
+            prompt_context = raw_search.result()
             
-        # Extract document paths from search results
-        json_data = json.loads(prompt_context) if isinstance(prompt_context, str) else prompt_context
-        relative_paths = set(item['relative_path'] for item in json_data['results'])
+        # Collect document paths and the chunks that fit the context budget in one pass
+        relative_paths = set()
+        results = []
+        remaining = APP_CONFIG["CONTEXT_CHAR_BUDGET"]
+        for item in prompt_context['results']:
+            chunk = item['chunk']
+            if len(chunk) > remaining:
+                if remaining > 0:
+                    results.append({"chunk": chunk[:remaining], "relative_path": item['relative_path']})
+                    relative_paths.add(item['relative_path'])
+                break
+            results.append(item)
+            relative_paths.add(item['relative_path'])
+            remaining -= len(chunk)
+        context_data = {"results": results}
         
         # Build the enhanced prompt
-        prompt = PromptBuilder.create_main_prompt(question, chat_history, prompt_context)
+        prompt = PromptBuilder.create_main_prompt(question, chat_history, context_data)
         
-        return prompt, relative_paths, json_data
+        return prompt, relative_paths, context_data
     
     def _get_chat_history(self) -> List[Dict[str, str]]:
         """Get recent chat history based on sliding window"""
         window_size = st.session_state.sliding_window
-        start_index = max(0, len(st.session_state.messages) - window_size)
-        return st.session_state.messages[start_index:len(st.session_state.messages)]
+        messages = st.session_state.messages
+        return [self._truncate_turn(m) for m in islice(messages, max(0, len(messages) - window_size), None)]
+    
+    @staticmethod
+    def _truncate_turn(message: Dict[str, str]) -> Dict[str, str]:
+        """Reduce a history message to a capped role/content pair"""
+        content = message["content"]
+        if message["role"] == "assistant":
+            content = _HISTORY_NOISE_RE.sub("", content)
+        return {"role": message["role"], "content": content[:APP_CONFIG["HISTORY_CHARS"][message["role"]]]}
     
-    def _summarize_conversation(self, chat_history: List[Dict[str, str]], question: str) -> str:
-        """Summarize the conversation to provide better context for retrieval"""
-        prompt = PromptBuilder.create_chat_summary_prompt(chat_history, question)
+    def _summarize_conversation(self, question: str) -> str:
+        """Extend the prior summary with the messages since it was made, to give retrieval better context"""
+        messages = st.session_state.messages
+        message_count = st.session_state.message_count
+        
+        # Short conversations are searched with the raw user turns, without an extra LLM call
+        if message_count <= 4:
+            return " ".join(m["content"] for m in messages if m["role"] == "User")
+        
+        # The current question is the last message; only the turns before it are new to the summary.
+        # The deque drops old messages, so map the running count back to a position in it
+        start = max(0, st.session_state.last_summary_upto - (message_count - len(messages)))
+        new_messages = [self._truncate_turn(m) for m in islice(messages, start, len(messages) - 1)]
+        prompt = PromptBuilder.create_chat_summary_prompt(st.session_state.last_summary, new_messages, question)
         summary = self.snowflake_service.complete_with_llm(st.session_state.model_name, prompt)
         
-        return summary.replace("'", "")
+        st.session_state.last_summary = summary
+        st.session_state.last_summary_upto = message_count
+        return summary
     
     def _update_related_documents(self, relative_paths: Set[str]):
         """Update related documents in session state for display in the right column"""
         if relative_paths:
-            documents = []
-            for path in relative_paths:
-                url_link = self.snowflake_service.get_document_url(path)
-                documents.append((path, url_link))
-            
-            st.session_state.related_documents = documents
+            paths = list(relative_paths)
+            url_map = self.snowflake_service.get_document_urls(paths)
+            st.session_state.related_documents = [(path, url_map.get(path, "#")) for path in paths]
 
 
 def main():